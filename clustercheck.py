@@ -3,15 +3,17 @@ import argparse
 import logging
 import re
 import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Type
 
 from urllib.parse import urlparse
 
-import requests as requests
-import yaml
 import socket
-import websocket
+
+# requests, yaml and websocket are slow to import, they are imported where used
 
 log = logging.getLogger("clustercheck")
 
@@ -28,15 +30,18 @@ class Plugin(abc.ABC):
         return cls.__name__
 
     def __init_subclass__(cls: "Type[Plugin]"):
-        Plugin._plugins_[cls.name()] = cls()
+        # instantiated by the checker on first use
+        Plugin._plugins_[cls.name()] = cls
 
 
 class Report:
-    def __init__(self, ok: bool, msg: str, check: "CheckConfig"):
+    __slots__ = ("ok", "msg", "check", "time")
+
+    def __init__(self, ok: bool, msg: str, check: "CheckConfig", at: float = None):
         self.ok = ok
         self.msg = msg
         self.check = check
-        self.time = time.time()
+        self.time = time.time() if at is None else at
 
     def format(self, fmt):
         pass_fail = "PASS" if self.ok else "FAIL"
@@ -45,27 +50,164 @@ class Report:
         )
 
 
+_CHUNK_SIZE = 65536
+_REGEX_META = frozenset(".^$*+?{}[]\\|()")
+
+
+def _is_ascii_literal(pattern):
+    return all(ord(c) < 128 and c not in _REGEX_META for c in pattern)
+
+
+# resp -> (ok, msg), picked once per check so the hot path has no branching
+def _make_http_expect(expect_status, expect_contains_re, max_body_bytes):
+    if expect_contains_re is None:
+
+        def expect(resp):
+            # drain (bounded) so the connection can go back to the pool
+            n = 0
+            for chunk in resp.iter_content(_CHUNK_SIZE):
+                n += len(chunk)
+                if n >= max_body_bytes:
+                    break
+            return resp.status_code == expect_status, "http(s) status"
+
+    else:
+        search = expect_contains_re.search
+        # only plain ascii strings are bytes, a match on those is final
+        literal = isinstance(expect_contains_re.pattern, bytes)
+        overlap = len(expect_contains_re.pattern) - 1 if literal else 0
+
+        def expect(resp):
+            if resp.status_code != expect_status:
+                return False, "http(s) status"
+            # never hold more than max_body_bytes
+            buf = bytearray()
+            for chunk in resp.iter_content(_CHUNK_SIZE):
+                # a new match must end in the new data, don't rescan the rest
+                start = max(0, len(buf) - overlap)
+                buf += chunk
+                del buf[max_body_bytes:]
+                if literal and search(buf, start):
+                    return True, "http(s) text contains"
+                if len(buf) >= max_body_bytes:
+                    break
+            if literal:
+                return False, "http(s) text contains"
+            # a regex can depend on what follows ($, lookahead), search once at the end
+            text = buf.decode(resp.encoding or "utf-8", "replace")
+            return bool(search(text)), "http(s) text contains"
+
+    return expect
+
+
+def _is_seconds(val):
+    return isinstance(val, (int, float)) and not isinstance(val, bool) and val > 0
+
+
 class CheckConfig:
-    def __init__(self, url, args, plugin=None, expect_status=200, expect_contains=None):
+    __slots__ = (
+        "url",
+        "args",
+        "plugin",
+        "expect_status",
+        "expect_contains",
+        "expect_contains_re",
+        "scheme",
+        "timeout",
+        "expect",
+        "max_body_bytes",
+        "follow_redirects",
+    )
+
+    # (connect, read) seconds
+    DEFAULT_TIMEOUT = (5, 10)
+    DEFAULT_MAX_BODY_BYTES = 1 << 20
+
+    def __init__(
+        self,
+        url,
+        args,
+        plugin=None,
+        expect_status=200,
+        expect_contains=None,
+        timeout=DEFAULT_TIMEOUT,
+        max_body_bytes=DEFAULT_MAX_BODY_BYTES,
+        follow_redirects=True,
+    ):
         self.url = url
+        self.scheme = urlparse(url).scheme
         self.args = args
         self.plugin = plugin
+        if timeout is None:
+            timeout = self.DEFAULT_TIMEOUT
+        elif _is_seconds(timeout):
+            timeout = (timeout, timeout)
+        elif (
+            not isinstance(timeout, (list, tuple))
+            or len(timeout) != 2
+            # None is "no timeout" for that half, as in requests
+            or not all(t is None or _is_seconds(t) for t in timeout)
+        ):
+            raise ValueError(
+                "timeout must be seconds or [connect, read], got %r" % (timeout,)
+            )
+        self.timeout = tuple(timeout)
+        self.follow_redirects = follow_redirects
+        # defaults go in here, so checks never need to modify args
+        if not plugin and self.scheme in ("http", "https"):
+            self.args = dict(args)
+            if not self.args.get("method"):
+                self.args["method"] = "GET"
+            self.args.setdefault("timeout", self.timeout)
+            self.args.setdefault("stream", True)
+            self.args.setdefault("allow_redirects", follow_redirects)
+        elif not plugin and self.scheme in ("ws", "wss"):
+            self.args = dict(args)
+            self.args.setdefault("timeout", self.timeout[0])
         self.expect_status = expect_status
         self.expect_contains = expect_contains
+        self.expect_contains_re = None
+        if expect_contains:
+            pattern = expect_contains
+            if _is_ascii_literal(expect_contains):
+                # a plain ascii string means the same on bytes, match the raw body
+                pattern = expect_contains.encode("ascii")
+            self.expect_contains_re = re.compile(pattern)
+        if max_body_bytes is None:
+            max_body_bytes = self.DEFAULT_MAX_BODY_BYTES
+        elif (
+            not isinstance(max_body_bytes, int)
+            or isinstance(max_body_bytes, bool)
+            or max_body_bytes <= 0
+        ):
+            raise ValueError(
+                "max_body_bytes must be a positive int, got %r" % (max_body_bytes,)
+            )
+        self.max_body_bytes = max_body_bytes
+        self.expect = _make_http_expect(
+            expect_status, self.expect_contains_re, self.max_body_bytes
+        )
 
     @staticmethod
     def from_dict(dct):
-        args = dct.get("args", {})
+        expect = dct.get("expect") or {}
         return CheckConfig(
             url=dct["url"],
-            args=args,
+            args=dct.get("args") or {},
             plugin=dct.get("plugin"),
-            expect_status=dct.get("expect", {}).get("status", 200),
-            expect_contains=dct.get("expect", {}).get("contains", None),
+            expect_status=expect.get("status", 200),
+            expect_contains=expect.get("contains"),
+            timeout=dct.get("timeout", CheckConfig.DEFAULT_TIMEOUT),
+            max_body_bytes=dct.get(
+                "max_body_bytes", CheckConfig.DEFAULT_MAX_BODY_BYTES
+            ),
+            follow_redirects=dct.get("follow_redirects", True),
         )
 
 
 class PluginConfig:
+    __slots__ = ("lib", "name", "args")
+
     def __init__(self, lib, name, args):
         self.lib = lib
         self.name = name
@@ -82,9 +224,33 @@ class PluginConfig:
 
 class Config:
     DEFAULT_FORMAT = "{ok} [{time}] {message} {config.url}"
-
-    def __init__(self, dns_map=None, plugins=None, checks=None):
+    DEFAULT_MAX_WORKERS = 64
+    DEFAULT_DNS_CACHE_TTL = 300
+
+    __slots__ = (
+        "output_format",
+        "dns_map",
+        "checks",
+        "plugins",
+        "max_workers",
+        "dns_cache_ttl",
+        "trust_env",
+    )
+
+    def __init__(
+        self,
+        dns_map=None,
+        plugins=None,
+        checks=None,
+        max_workers=None,
+        dns_cache_ttl=DEFAULT_DNS_CACHE_TTL,
+        trust_env=False,
+    ):
         self.output_format = self.DEFAULT_FORMAT
+        self.max_workers: int = max_workers or self.DEFAULT_MAX_WORKERS
+        self.dns_cache_ttl: float = dns_cache_ttl
+        # honor proxy / ca bundle env vars for http checks
+        self.trust_env: bool = trust_env
         self.dns_map: Dict[str, str] = dns_map or {}
         self.checks: List[CheckConfig] = [
             CheckConfig.from_dict(ent) for ent in (checks or [])
@@ -95,8 +261,16 @@ class Config:
 
     @classmethod
     def from_file(cls, path):
+        import yaml
+
+        try:
+            from yaml import CSafeLoader as Loader
+        except ImportError:
+            # pyyaml built without libyaml
+            from yaml import SafeLoader as Loader
+
         with open(path, "r") as f:
-            cfg = yaml.safe_load(f)
+            cfg = yaml.load(f, Loader=Loader)
         return cls.from_dict(cfg)
 
     @classmethod
@@ -105,6 +279,9 @@ class Config:
             dns_map=dct.get("dns_map", {}),
             plugins=dct.get("plugins", []),
             checks=dct.get("checks", []),
+            max_workers=dct.get("max_workers"),
+            dns_cache_ttl=dct.get("dns_cache_ttl", cls.DEFAULT_DNS_CACHE_TTL),
+            trust_env=dct.get("trust_env", False),
         )
 
 
@@ -113,13 +290,59 @@ class Checker:
         self.reports: List[Report] = []
         self.config = config
         self.results = []
-        self.plugins = {}
+        self.plugins: Dict[str, Type[Plugin]] = {}
+        self._plugin_instances: Dict[str, Plugin] = {}
+        self._plugin_lock = threading.Lock()
+        self._handlers = {
+            "http": self._do_http_check,
+            "https": self._do_http_check,
+            "ws": self._do_ws_check,
+            "wss": self._do_ws_check,
+        }
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._session:
+            self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # shared across checks, so connections to the same host are reused
+        with self._session_lock:
+            if self._session is None:
+                import http.cookiejar
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                # checks must stay independent, never carry cookies between them
+                session.cookies.set_policy(
+                    http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+                )
+                # skips per-request env proxy/netrc/ca bundle lookups
+                session.trust_env = self.config.trust_env
+                adapter = HTTPAdapter(
+                    pool_connections=self.config.max_workers,
+                    pool_maxsize=self.config.max_workers,
+                    max_retries=0,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            return self._session
 
     def reset(self):
         self.results = []
 
     def check(self):
-        self.setup_dns(self.config.dns_map)
+        self.setup_dns(self.config.dns_map, self.config.dns_cache_ttl)
         self.load_plugins(self.config.plugins)
         self.check_all(self.config.checks)
         return self.results
@@ -127,21 +350,60 @@ class Checker:
     def ok(self):
         return all(r.ok for r in self.reports)
 
+    DNS_CACHE_SIZE = 1024
+
     @staticmethod
-    def setup_dns(dns_map: Dict[str, str]):
-        dns_map = dns_map.copy()
+    def setup_dns(
+        dns_map: Dict[str, str], cache_ttl: float = Config.DEFAULT_DNS_CACHE_TTL
+    ):
+        dns_map = {src.lower().rstrip("."): dest for src, dest in dns_map.items()}
 
-        for src, dest in dns_map.items():
-            dns_map[src.lower().rstrip(".")] = dest
+        lock = threading.Lock()
 
         def make_new_func(prv_func):
-            def new_func(*args):
-                map = dns_map.get(args[0].lower().rstrip("."))
-                if map:
-                    return prv_func(*((map,) + args[1:]))
-                else:
-                    return prv_func(*args)
+            # replace a previous setup_dns rather than stacking on top of it,
+            # other patches (even functools.wraps ones) are left in place
+            prv_func = getattr(prv_func, "_clustercheck_orig_", prv_func)
+
+            if not dns_map:
+                resolve = prv_func
+            else:
+
+                def resolve(*args):
+                    host = args[0]
+                    # most lookups are already normalized, skip the rstrip/lower
+                    map = dns_map.get(host)
+                    if not map and isinstance(host, str):
+                        map = dns_map.get(host.lower().rstrip("."))
+                    if map:
+                        return prv_func(*((map,) + args[1:]))
+                    else:
+                        return prv_func(*args)
 
+                resolve._clustercheck_orig_ = prv_func
+
+            if not cache_ttl:
+                return resolve
+
+            # args -> (expiry, result), oldest first
+            cache = OrderedDict()
+
+            def new_func(*args):
+                now = time.monotonic()
+                with lock:
+                    hit = cache.get(args)
+                    if hit and now < hit[0]:
+                        cache.move_to_end(args)
+                        return hit[1]
+                res = resolve(*args)
+                with lock:
+                    cache[args] = (now + cache_ttl, res)
+                    cache.move_to_end(args)
+                    if len(cache) > Checker.DNS_CACHE_SIZE:
+                        cache.popitem(last=False)
+                return res
+
+            new_func._clustercheck_orig_ = prv_func
             return new_func
 
         socket.getaddrinfo = make_new_func(socket.getaddrinfo)
@@ -149,37 +411,64 @@ class Checker:
         socket.gethostbyname_ex = make_new_func(socket.gethostbyname_ex)
 
     def check_all(self, checks: List[CheckConfig]):
-        g: CheckConfig
-        for g in checks:
-            uri = urlparse(g.url)
+        if not checks:
+            return
+        # checks are network bound, run them concurrently, report in order
+        workers = min(self.config.max_workers, len(checks))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(self._run_one, checks))
+        for ok, msg, g, at in results:
+            self.report(ok, msg, g, at)
+
+    def _run_one(self, g: CheckConfig):
+        try:
             if g.plugin:
-                p: Plugin = self.plugins[g.plugin]
-                self.report(p.check(g.url, g.args), p.name, g)
-            elif uri.scheme in ("http", "https"):
-                if not g.args.get("method"):
-                    g.args["method"] = "GET"
-                try:
-                    resp = requests.request(url=g.url, **g.args)
-                    ok = resp.status_code == g.expect_status
-                    if ok and g.expect_contains:
-                        self.report(
-                            re.search(g.expect_contains, resp.text),
-                            "http(s) text contains",
-                            g,
-                        )
-                    else:
-                        self.report(ok, "http(s) status", g)
-                except Exception as ex:
-                    self.report(False, repr(ex), g)
-            elif uri.scheme in ("ws", "wss"):
-                ws = websocket.create_connection(g.url, **g.args)
-                ws.ping()
-                self.report(ws.connected, "websocket connected", g)
+                p = self._get_plugin(g.plugin)
+                ok, msg = p.check(g.url, g.args), p.name
             else:
-                self.report(False, "invalid scheme", g)
+                ok, msg, _ = self._handlers.get(g.scheme, self._do_invalid_check)(g)
+        except Exception as ex:
+            # one broken plugin must not lose the other results
+            ok, msg = False, repr(ex)
+        # reports are made after the pool finishes, record when this check did
+        return ok, msg, g, time.time()
+
+    def _get_plugin(self, name) -> Plugin:
+        with self._plugin_lock:
+            p = self._plugin_instances.get(name)
+            if p is None:
+                p = self._plugin_instances[name] = self.plugins[name]()
+            return p
+
+    def _do_http_check(self, g: CheckConfig):
+        try:
+            with self._get_session().request(url=g.url, **g.args) as resp:
+                ok, msg = g.expect(resp)
+            return ok, msg, g
+        except Exception as ex:
+            return False, repr(ex), g
+
+    @staticmethod
+    def _do_ws_check(g: CheckConfig):
+        import websocket
+
+        try:
+            ws = websocket.create_connection(g.url, **g.args)
+            try:
+                ws.ping()
+                return ws.connected, "websocket connected", g
+            finally:
+                # don't hold sockets open for the rest of the run
+                ws.close()
+        except Exception as ex:
+            return False, repr(ex), g
+
+    @staticmethod
+    def _do_invalid_check(g: CheckConfig):
+        return False, "invalid scheme", g
 
-    def report(self, ok: bool, msg: str, check: CheckConfig):
-        self.reports += [Report(bool(ok), msg, check)]
+    def report(self, ok: bool, msg: str, check: CheckConfig, at: float = None):
+        self.reports.append(Report(bool(ok), msg, check, at))
 
     def print_reports(self, fmt, file, verbose):
         for r in self.reports:
@@ -226,8 +515,8 @@ def main():
     if args.debug:
         log.setLevel(logging.DEBUG)
     config = Config.from_file(args.config)
-    checker = Checker(config)
-    checker.check()
+    with Checker(config) as checker:
+        checker.check()
     checker.print_reports(config.output_format, sys.stderr, verbose=args.verbose)
     sys.exit(checker.ok())
 
@@ -1,6 +1,10 @@
+import functools
+import http.server
 import os
 import socket
 import sys
+import threading
+import time
 
 import pytest
 import yaml
@@ -47,6 +51,33 @@ def plugin_config():
     )
 
 
+@pytest.fixture
+def local_server():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = b"hello from clustercheck"
+            if self.path == "/login":
+                self.send_response(200)
+                self.send_header("Set-Cookie", "session=abc; Path=/")
+            elif self.path == "/nocookie":
+                self.send_response(400 if self.headers.get("Cookie") else 200)
+            else:
+                self.send_response(int(self.path.strip("/") or 200))
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%s" % srv.server_address[1]
+    srv.shutdown()
+    srv.server_close()
+
+
 @pytest.fixture
 def dnsmap_config():
     yield clustercheck.Config(dns_map={"www.microsoft.com": "www.google.com"})
@@ -61,6 +92,43 @@ def test_dns_inject(dnsmap_config):
     assert ipaddr1 == ipaddr2
 
 
+def test_dns_cache(monkeypatch):
+    calls = []
+
+    def fake_gethostbyname(host):
+        calls.append(host)
+        return "10.0.0.%s" % len(calls)
+
+    # setup_dns patches the socket module, restore it afterwards
+    monkeypatch.setattr(socket, "getaddrinfo", socket.getaddrinfo)
+    monkeypatch.setattr(socket, "gethostbyname_ex", socket.gethostbyname_ex)
+    monkeypatch.setattr(socket, "gethostbyname", fake_gethostbyname)
+    clustercheck.Checker.setup_dns({"a.example.com": "b.example.com"}, 300)
+    assert socket.gethostbyname("a.example.com") == "10.0.0.1"
+    assert socket.gethostbyname("a.example.com") == "10.0.0.1"
+    assert socket.gethostbyname("c.example.com") == "10.0.0.2"
+    assert calls == ["b.example.com", "c.example.com"]
+
+    # process wide: setting up again replaces the cache, it doesn't stack
+    clustercheck.Checker.setup_dns({}, 300)
+    assert socket.gethostbyname._clustercheck_orig_ is fake_gethostbyname
+    assert socket.gethostbyname("a.example.com") == "10.0.0.3"
+    clustercheck.Checker.setup_dns({}, 0)
+    assert socket.gethostbyname is fake_gethostbyname
+
+    # someone else's patch is kept, even if it looks like a functools wrapper
+    @functools.wraps(fake_gethostbyname)
+    def other_patch(host):
+        calls.append("other")
+        return fake_gethostbyname(host)
+
+    socket.gethostbyname = other_patch
+    clustercheck.Checker.setup_dns({}, 300)
+    assert socket.gethostbyname._clustercheck_orig_ is other_patch
+    socket.gethostbyname("d.example.com")
+    assert calls[-2:] == ["other", "d.example.com"]
+
+
 def test_urls(generic_config):
     cfg = generic_config
     checker = clustercheck.Checker(cfg)
@@ -75,11 +143,40 @@ def test_plugins(plugin_config):
     cfg = plugin_config
     checker = clustercheck.Checker(cfg)
     checker.load_plugins(cfg.plugins)
+    # not instantiated until a check uses it
+    assert isinstance(checker.plugins["MyCheck"], type)
     checker.check_all(cfg.checks)
     assert len(checker.reports) == len(cfg.checks)
     assert checker.reports[0].ok
 
 
+def test_plugin_errors_and_times(local_server):
+    class SlowCheck(clustercheck.Plugin):
+        def check(self, url, args):
+            time.sleep(0.2)
+            return True
+
+    class BrokenCheck(clustercheck.Plugin):
+        def check(self, url, args):
+            raise RuntimeError("boom")
+
+    cfg = clustercheck.Config(
+        checks=[
+            {"url": local_server, "plugin": "SlowCheck"},
+            {"url": local_server, "plugin": "BrokenCheck"},
+            {"url": local_server, "plugin": "NoSuchCheck"},
+            {"url": local_server},
+        ]
+    )
+    checker = clustercheck.Checker(cfg)
+    checker.load_plugins([])
+    checker.check_all(cfg.checks)
+    assert [r.ok for r in checker.reports] == [True, False, False, True]
+    assert "boom" in checker.reports[1].msg
+    # each report has the time its own check finished
+    assert checker.reports[0].time > checker.reports[3].time
+
+
 def test_main(generic_config, tmp_path, capsys):
     cfg = {
         "checks": [
@@ -106,3 +203,152 @@ def test_main(generic_config, tmp_path, capsys):
     assert lines[0].startswith("PASS")
     assert lines[1].startswith("PASS")
     assert lines[2].startswith("FAIL")
+
+
+def test_concurrent_order(local_server):
+    statuses = [200, 404, 200, 500] * 5
+    cfg = clustercheck.Config(
+        checks=[{"url": "%s/%s" % (local_server, st)} for st in statuses]
+    )
+    checker = clustercheck.Checker(cfg)
+    checker.check_all(cfg.checks)
+    assert [r.check.url for r in checker.reports] == [g.url for g in cfg.checks]
+    assert [r.ok for r in checker.reports] == [st == 200 for st in statuses]
+
+
+def test_contains(local_server):
+    cfg = clustercheck.Config(
+        checks=[
+            {"url": local_server, "expect": {"contains": "from cluster.*"}},
+            {"url": local_server, "expect": {"contains": "^nope"}},
+        ]
+    )
+    checker = clustercheck.Checker(cfg)
+    checker.check_all(cfg.checks)
+    assert checker.reports[0].ok
+    assert not checker.reports[1].ok
+
+
+def test_contains_body_cap(local_server):
+    cfg = clustercheck.Config(
+        checks=[
+            {
+                "url": local_server,
+                "expect": {"contains": "clustercheck"},
+                "max_body_bytes": 5,
+            },
+        ]
+    )
+    checker = clustercheck.Checker(cfg)
+    checker.check_all(cfg.checks)
+    assert not checker.reports[0].ok
+
+
+def test_max_body_bytes_validation():
+    g = clustercheck.CheckConfig.from_dict({"url": "http://x/", "max_body_bytes": None})
+    assert g.max_body_bytes == clustercheck.CheckConfig.DEFAULT_MAX_BODY_BYTES
+    for bad in (0, -1, 1.5, "10", True):
+        with pytest.raises(ValueError):
+            clustercheck.CheckConfig.from_dict(
+                {"url": "http://x/", "max_body_bytes": bad}
+            )
+
+
+def test_timeout_defaults():
+    http = clustercheck.CheckConfig.from_dict({"url": "http://x/", "timeout": 3})
+    assert http.args == {
+        "method": "GET",
+        "timeout": (3, 3),
+        "stream": True,
+        "allow_redirects": True,
+    }
+    ws = clustercheck.CheckConfig.from_dict({"url": "ws://x/", "timeout": [1, 2]})
+    assert ws.args == {"timeout": 1}
+    own = clustercheck.CheckConfig.from_dict(
+        {"url": "https://x/", "args": {"timeout": 7}}
+    )
+    assert own.args["timeout"] == 7
+    none = clustercheck.CheckConfig.from_dict({"url": "http://x/", "timeout": None})
+    assert none.timeout == clustercheck.CheckConfig.DEFAULT_TIMEOUT
+    pair = clustercheck.CheckConfig.from_dict(
+        {"url": "http://x/", "timeout": [None, 2.5]}
+    )
+    assert pair.timeout == (None, 2.5)
+    for bad in ([5], "10", True, 0, -1, [1, "2"], [True, 1], [0, 1]):
+        with pytest.raises(ValueError):
+            clustercheck.CheckConfig.from_dict({"url": "http://x/", "timeout": bad})
+
+
+def test_no_shared_cookies(local_server):
+    cfg = clustercheck.Config(
+        checks=[{"url": local_server + "/login"}, {"url": local_server + "/nocookie"}]
+    )
+    checker = clustercheck.Checker(cfg)
+    checker.check_all(cfg.checks[:1])
+    checker.check_all(cfg.checks[1:])
+    assert checker.reports[0].ok
+    assert checker.reports[1].ok
+
+
+class FakeResponse:
+    def __init__(self, chunks, status_code=200, encoding=None):
+        self.chunks = chunks
+        self.status_code = status_code
+        self.encoding = encoding
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+
+@pytest.mark.parametrize(
+    "pattern, chunks",
+    [
+        ("status: ok$", [b"status: ok", b"ay, actually down"]),
+        ("ok(?!ay)", [b"status: ok", b"ay, actually down"]),
+        ("ok(?!ay!)", [b"x" * 65536 + b"status: okay", b"!, down"]),
+        ("healthy(?!.*degraded)", [b"healthy, now ", b"degraded"]),
+    ],
+)
+def test_contains_chunk_boundary(pattern, chunks):
+    g = clustercheck.CheckConfig.from_dict(
+        {"url": "http://x/", "expect": {"contains": pattern}}
+    )
+    assert not g.expect(FakeResponse(chunks))[0]
+    assert g.expect(FakeResponse([b"".join(chunks[:1])]))[0]
+
+
+def test_contains_literal_stops_early():
+    g = clustercheck.CheckConfig.from_dict(
+        {"url": "http://x/", "expect": {"contains": "status: ok"}}
+    )
+
+    def chunks():
+        yield b"x" * 100 + b"status: o"
+        yield b"k"
+        raise AssertionError("read past the match")
+
+    assert g.expect(FakeResponse(chunks()))[0]
+
+
+def test_contains_non_ascii():
+    g = clustercheck.CheckConfig.from_dict(
+        {"url": "http://x/", "expect": {"contains": "caf[é]"}}
+    )
+    assert not g.expect(FakeResponse(["cafè".encode("utf-8")], encoding="utf-8"))[0]
+    assert g.expect(FakeResponse(["café".encode("utf-8")], encoding="utf-8"))[0]
+
+
+@pytest.mark.parametrize("pattern", [r"caf\w", r"caf\u00e9", "^caf.$"])
+def test_contains_str_regex(pattern):
+    g = clustercheck.CheckConfig.from_dict(
+        {"url": "http://x/", "expect": {"contains": pattern}}
+    )
+    assert isinstance(g.expect_contains_re.pattern, str)
+    assert g.expect(FakeResponse(["café".encode("utf-8")], encoding="utf-8"))[0]
+
+
+def test_contains_literal_is_bytes():
+    g = clustercheck.CheckConfig.from_dict(
+        {"url": "http://x/", "expect": {"contains": "status: ok"}}
+    )
+    assert g.expect_contains_re.pattern == b"status: ok"